@@ -7,17 +7,37 @@ Caracteristicas principales:
 - Base de datos de proveedores con historial de precios
 - Inventario que permite dar fechas de entrega basadas en stock y lead time
 
-Requisitos: pip install customtkinter
+Requisitos: pip install customtkinter numpy
 Ejecutar: python registro_taller.py
 """
 
 import customtkinter as ctk
+from tkinter import messagebox
+import numpy as np
 import sqlite3
 from datetime import datetime, timedelta
 import os
+import re
+import time
 import threading
+from contextlib import contextmanager
 
 DB_FILE = "taller.db"
+ARCHIVE_DIR = "archivo"
+OPENING_REF = "SALDO INICIAL"
+FORECAST_HISTORY_DAYS = 3 * 365
+FORECAST_ALPHA = 0.1
+FORECAST_MA_DAYS = 28
+FORECAST_HORIZON_DAYS = 3650
+FORECAST_POLL_MS = 200
+VALUATION_BATCH = 5000
+SCAN_FLUSH_MS = 500
+SCAN_BATCH_SIZE = 50
+SCAN_IDLE_MS = 1500
+CATALOG_CHECK_MS = 2000
+CATALOG_TABLES = ('products', 'vehicles', 'technicians', 'suppliers')
+WRITE_SQL = re.compile(r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+(?:\w+\.)?(\w+)", re.IGNORECASE)
+MOVEMENT_COLUMNS = "id, product_id, qty, movement_type, date, vehicle_id, technician_id, reference, note, is_opening"
 
 # ---------------------- Base de datos ----------------------
 
@@ -63,14 +83,29 @@ def init_db():
         )
     ''')
 
+    # Clientes
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            phone TEXT,
+            email TEXT,
+            note TEXT
+        )
+    ''')
+
     # Vehiculos
     c.execute('''
         CREATE TABLE IF NOT EXISTS vehicles (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             plate TEXT UNIQUE,
-            owner TEXT
+            owner TEXT,
+            customer_id INTEGER REFERENCES customers(id)
         )
     ''')
+    # bases creadas antes de existir la tabla de clientes
+    if 'customer_id' not in [r[1] for r in c.execute("PRAGMA table_info(vehicles)")]:
+        c.execute("ALTER TABLE vehicles ADD COLUMN customer_id INTEGER REFERENCES customers(id)")
 
     # Tecnicos
     c.execute('''
@@ -93,11 +128,121 @@ def init_db():
             technician_id INTEGER,
             reference TEXT,
             note TEXT,
+            is_opening INTEGER DEFAULT 0,
             FOREIGN KEY(product_id) REFERENCES products(id),
             FOREIGN KEY(vehicle_id) REFERENCES vehicles(id),
             FOREIGN KEY(technician_id) REFERENCES technicians(id)
         )
     ''')
+    # saldo inicial de un periodo archivado: solo lo escribe archive_movements
+    if 'is_opening' not in [r[1] for r in c.execute("PRAGMA table_info(inventory_movements)")]:
+        c.execute("ALTER TABLE inventory_movements ADD COLUMN is_opening INTEGER DEFAULT 0")
+
+    # Ordenes de reparacion
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS repair_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            vehicle_id INTEGER,
+            technician_id INTEGER,
+            status TEXT DEFAULT 'OPEN' CHECK(status IN ('OPEN','ALLOCATED','FINISHED','CANCELED')),
+            date TEXT,
+            note TEXT,
+            FOREIGN KEY(vehicle_id) REFERENCES vehicles(id),
+            FOREIGN KEY(technician_id) REFERENCES technicians(id)
+        )
+    ''')
+
+    # Lineas de orden: RESERVED cuenta contra el stock disponible sin generar OUT
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS repair_order_lines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            product_id INTEGER,
+            qty INTEGER,
+            status TEXT DEFAULT 'RESERVED' CHECK(status IN ('RESERVED','ALLOCATED','RELEASED')),
+            movement_id INTEGER,
+            FOREIGN KEY(order_id) REFERENCES repair_orders(id),
+            FOREIGN KEY(product_id) REFERENCES products(id),
+            FOREIGN KEY(movement_id) REFERENCES inventory_movements(id)
+        )
+    ''')
+
+    # Valorizacion (costo promedio ponderado) mantenida incrementalmente
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS product_valuation (
+            product_id INTEGER PRIMARY KEY,
+            qty INTEGER,
+            value REAL,
+            avg_cost REAL,
+            FOREIGN KEY(product_id) REFERENCES products(id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS movement_costs (
+            movement_id INTEGER PRIMARY KEY,
+            product_id INTEGER,
+            date TEXT,
+            unit_cost REAL,
+            total_cost REAL,
+            value_delta REAL,
+            movement_type TEXT,
+            vehicle_id INTEGER
+        )
+    ''')
+    # Al archivar, movement_costs se resume por mes: variación del valor del
+    # inventario y costo de salidas por vehículo
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS valuation_month_delta (
+            month TEXT PRIMARY KEY,
+            value_delta REAL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS archived_vehicle_costs (
+            vehicle_id INTEGER,
+            month TEXT,
+            lines INTEGER,
+            cost REAL,
+            PRIMARY KEY (vehicle_id, month)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS valuation_state (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            last_movement_id INTEGER
+        )
+    ''')
+
+    # Generación por tabla de catálogo, compartida entre procesos: la suben los
+    # triggers y CatalogCache la compara para recargar solo lo que cambió
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_generation (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table in CATALOG_TABLES:
+        c.execute("INSERT OR IGNORE INTO catalog_generation (name, generation) VALUES (?, 0)", (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_generation AFTER {event} ON {table}
+                BEGIN
+                    UPDATE catalog_generation SET generation = generation + 1 WHERE name = '{table}';
+                END
+            ''')
+
+    # Indices para sumas de stock y listados por fecha
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movements_product ON inventory_movements(product_id, movement_type, qty)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movements_date ON inventory_movements(date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movements_vehicle ON inventory_movements(vehicle_id, movement_type, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_customers_name ON customers(name COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_vehicles_plate_nocase ON vehicles(plate COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_vehicles_customer ON vehicles(customer_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_supplier_prices_product ON supplier_prices(product_id, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movement_costs_date ON movement_costs(date, value_delta)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movement_costs_vehicle ON movement_costs(vehicle_id, movement_type, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_order ON repair_order_lines(order_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_reserved ON repair_order_lines(status, product_id, qty)")
 
     conn.commit()
     conn.close()
@@ -108,6 +253,16 @@ class DB:
         self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
         self.lock = threading.Lock()
+        # generación por tabla: sube con cada escritura y invalida el catálogo en memoria
+        self.generations = {}
+        self.conn.set_trace_callback(self._on_statement)
+        self.catalog = CatalogCache(self)
+
+    def _on_statement(self, sql):
+        m = WRITE_SQL.match(sql)
+        if m:
+            table = m.group(1).lower()
+            self.generations[table] = self.generations.get(table, 0) + 1
 
     def query(self, sql, params=(), commit=False):
         with self.lock:
@@ -118,9 +273,166 @@ class DB:
                 return cur.lastrowid
             return cur.fetchall()
 
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Ejecuta varias sentencias en una sola transacción (commit o rollback)."""
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield cur
+            except Exception:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
     def close(self):
         self.conn.close()
 
+# ---------------------- Catálogo en memoria ----------------------
+
+def normalize_code(code):
+    return (code or '').strip().upper()
+
+class _Record:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+class ProductRec(_Record):
+    __slots__ = ('id', 'code', 'name', 'unit', 'min_stock', 'lead_time_days')
+
+class VehicleRec(_Record):
+    __slots__ = ('id', 'plate', 'owner', 'customer_id')
+
+class TechnicianRec(_Record):
+    __slots__ = ('id', 'name')
+
+class SupplierRec(_Record):
+    __slots__ = ('id', 'name', 'lead_time_days')
+
+class _CatalogTable:
+    __slots__ = ('generation', 'records', 'by_id', 'by_key', 'by_name', 'choices')
+
+class CatalogCache:
+    """Copia en memoria de products, vehicles, technicians y suppliers.
+    Cada tabla se recarga solo cuando su fila en catalog_generation cambió. Esa
+    tabla se relee cuando esta conexión escribe en el catálogo o cuando check()
+    detecta (PRAGMA data_version) un commit de otra conexión; las consultas
+    normales no ejecutan SQL.
+    """
+    TABLES = {
+        'products': (ProductRec, "SELECT id, code, name, unit, min_stock, lead_time_days FROM products ORDER BY name", 'code'),
+        'vehicles': (VehicleRec, "SELECT id, plate, owner, customer_id FROM vehicles ORDER BY plate", 'plate'),
+        'technicians': (TechnicianRec, "SELECT id, name FROM technicians ORDER BY name", None),
+        'suppliers': (SupplierRec, "SELECT id, name, lead_time_days FROM suppliers ORDER BY name", None),
+    }
+
+    def __init__(self, db):
+        self.db = db
+        self.tables = {}
+        self.data_version = None
+        self.generations = {}
+        self.local_generations = {}
+        self.lock = threading.Lock()
+
+    def _read_generations(self):
+        self.generations = dict(self.db.query("SELECT name, generation FROM catalog_generation"))
+
+    def check(self):
+        """Relee las generaciones si otra conexión hizo commit desde la última vez.
+        Se llama en los puntos de refresco y periódicamente, no en cada consulta.
+        """
+        # data_version solo cambia con commits de otras conexiones
+        data_version = self.db.query("PRAGMA data_version")[0][0]
+        if data_version != self.data_version:
+            self.data_version = data_version
+            self._read_generations()
+
+    def _table(self, name):
+        if self.data_version is None:
+            self.check()
+        # escrituras propias: las ve el trace de la conexión antes de cualquier check
+        local = self.db.generations.get(name, 0)
+        if local != self.local_generations.get(name, 0):
+            self.local_generations[name] = local
+            self._read_generations()
+        generation = self.generations.get(name, 0)
+        table = self.tables.get(name)
+        if table is not None and table.generation == generation:
+            return table
+        with self.lock:
+            table = self.tables.get(name)
+            if table is not None and table.generation == generation:
+                return table
+            rec_cls, sql, key = self.TABLES[name]
+            # la generación se leyó antes de la consulta: una escritura concurrente fuerza otra recarga
+            table = _CatalogTable()
+            table.generation = generation
+            table.records = [rec_cls(*r) for r in self.db.query(sql)]
+            table.by_id = {r.id: r for r in table.records}
+            table.by_key = {normalize_code(getattr(r, key)): r for r in table.records} if key else {}
+            # reversed: con nombres repetidos queda el primero en orden
+            table.by_name = {r.name: r for r in reversed(table.records)} if 'name' in rec_cls.__slots__ else {}
+            table.choices = None
+            self.tables[name] = table
+            return table
+
+    def warm(self):
+        for name in self.TABLES:
+            self._table(name)
+
+    def products(self):
+        return self._table('products').records
+
+    def vehicles(self):
+        return self._table('vehicles').records
+
+    def technicians(self):
+        return self._table('technicians').records
+
+    def suppliers(self):
+        return self._table('suppliers').records
+
+    def product(self, product_id):
+        return self._table('products').by_id.get(product_id)
+
+    def product_by_code(self, code):
+        return self._table('products').by_key.get(normalize_code(code))
+
+    def product_by_name(self, name):
+        return self._table('products').by_name.get(name)
+
+    def vehicle(self, vehicle_id):
+        return self._table('vehicles').by_id.get(vehicle_id)
+
+    def vehicle_by_plate(self, plate):
+        return self._table('vehicles').by_key.get(normalize_code(plate))
+
+    def choices(self, name):
+        """Valores 'id|texto' para los combobox, armados una vez por generación."""
+        table = self._table(name)
+        if table.choices is None:
+            if name == 'products':
+                table.choices = [f"{r.id}|{r.code} - {r.name}" for r in table.records]
+            elif name == 'vehicles':
+                table.choices = [f"{r.id}|{r.plate}" for r in table.records]
+            else:
+                table.choices = [f"{r.id}|{r.name}" for r in table.records]
+        return table.choices
+
+    def lookup(self, code):
+        """Lectura del escáner: ('product', id), ('vehicle', id) o None."""
+        product = self.product_by_code(code)
+        if product is not None:
+            return 'product', product.id
+        vehicle = self.vehicle_by_plate(code)
+        if vehicle is not None:
+            return 'vehicle', vehicle.id
+        return None
+
 # ---------------------- Lógica de inventario ----------------------
 
 def get_stock(db: DB, product_id: int):
@@ -133,11 +445,13 @@ def get_stock(db: DB, product_id: int):
 
 def estimate_delivery_date(db: DB, product_id: int, needed_qty: int):
     """Estimación simple:
+    - stock = disponible (físico menos reservas de órdenes abiertas)
     - Si stock >= needed_qty -> entrega inmediata (hoy)
     - Si stock < needed_qty -> buscar proveedores y usar su lead_time_days (promedio)
       y devolver la fecha estimada hoy + lead_time
     """
-    stock = get_stock(db, product_id)
+    physical, reserved = _stock_levels(db.query(_product_stock_sql(1), (product_id,))).get(product_id, (0, 0))
+    stock = physical - reserved
     if stock >= needed_qty:
         return datetime.now().date(), stock
 
@@ -149,9 +463,9 @@ def estimate_delivery_date(db: DB, product_id: int, needed_qty: int):
     lead_times = [r[0] for r in rows if r[0] is not None]
     if not lead_times:
         # fallback: use product lead_time
-        prod = db.query("SELECT lead_time_days FROM products WHERE id = ?", (product_id,))
+        prod = db.catalog.product(product_id)
         if prod:
-            lt = prod[0][0] or 7
+            lt = prod.lead_time_days or 7
         else:
             lt = 7
         return datetime.now().date() + timedelta(days=lt), stock
@@ -159,12 +473,682 @@ def estimate_delivery_date(db: DB, product_id: int, needed_qty: int):
     avg_lt = sum(lead_times) / len(lead_times)
     return datetime.now().date() + timedelta(days=int(round(avg_lt))), stock
 
+# ---------------------- Órdenes de reparación ----------------------
+
+class StockError(Exception):
+    """No hay stock disponible suficiente para reservar o asignar."""
+
+STOCK_LEVELS_SQL = '''
+    SELECT p.id,
+           COALESCE(m.physical, 0) AS physical,
+           COALESCE(r.reserved, 0) AS reserved
+    FROM products p
+    LEFT JOIN (
+        SELECT product_id, SUM(CASE WHEN movement_type='IN' THEN qty WHEN movement_type='OUT' THEN -qty ELSE 0 END) AS physical
+        FROM inventory_movements GROUP BY product_id
+    ) m ON m.product_id = p.id
+    LEFT JOIN (
+        SELECT product_id, SUM(qty) AS reserved
+        FROM repair_order_lines WHERE status = 'RESERVED' GROUP BY product_id
+    ) r ON r.product_id = p.id
+'''
+
+# Para pocos productos: sumas correlacionadas que recorren idx_movements_product e
+# idx_order_lines_reserved solo para los ids pedidos (las tablas derivadas de
+# STOCK_LEVELS_SQL suman todo el historial aunque se filtre afuera).
+PRODUCT_STOCK_SQL = '''
+    SELECT p.id,
+           COALESCE((SELECT SUM(CASE WHEN im.movement_type='IN' THEN im.qty WHEN im.movement_type='OUT' THEN -im.qty ELSE 0 END)
+                     FROM inventory_movements im WHERE im.product_id = p.id), 0) AS physical,
+           COALESCE((SELECT SUM(l.qty) FROM repair_order_lines l
+                     WHERE l.status = 'RESERVED' AND l.product_id = p.id), 0) AS reserved
+    FROM products p
+    WHERE p.id IN ({})
+'''
+
+def _stock_levels(rows):
+    return {r[0]: (int(r[1]), int(r[2])) for r in rows}
+
+def _product_stock_sql(count):
+    return PRODUCT_STOCK_SQL.format(','.join('?' * count))
+
+def get_stock_levels(db: DB):
+    """Stock físico y reservado de todos los productos en una sola consulta.
+    Devuelve {product_id: (fisico, reservado)}; disponible = fisico - reservado.
+    """
+    return _stock_levels(db.query(STOCK_LEVELS_SQL))
+
+def create_repair_order(db: DB, vehicle_id=None, technician_id=None, note=''):
+    return db.query(
+        "INSERT INTO repair_orders (vehicle_id, technician_id, status, date, note) VALUES (?,?,'OPEN',?,?)",
+        (vehicle_id, technician_id, datetime.now().isoformat(), note),
+        commit=True
+    )
+
+def reserve_part(db: DB, order_id: int, product_id: int, qty: int):
+    """Agrega una línea a la orden reservando stock disponible (sin movimiento OUT)."""
+    if qty <= 0:
+        raise ValueError("Cantidad inválida")
+    with db.transaction(immediate=True) as cur:
+        order = cur.execute("SELECT status FROM repair_orders WHERE id = ?", (order_id,)).fetchone()
+        if not order or order[0] != 'OPEN':
+            raise ValueError(f"La orden {order_id} no está abierta")
+        levels = _stock_levels(cur.execute(_product_stock_sql(1), (product_id,)).fetchall())
+        physical, reserved = levels.get(product_id, (0, 0))
+        if physical - reserved < qty:
+            raise StockError(f"Disponible {physical - reserved}, solicitado {qty}")
+        cur.execute(
+            "INSERT INTO repair_order_lines (order_id, product_id, qty, status) VALUES (?,?,?,'RESERVED')",
+            (order_id, product_id, qty)
+        )
+        return cur.lastrowid
+
+def allocate_order(db: DB, order_id: int):
+    """Convierte todas las reservas de la orden en salidas (OUT) en una sola transacción.
+    Si algún producto no alcanza, no se registra nada y se lanza StockError.
+    """
+    with db.transaction(immediate=True) as cur:
+        order = cur.execute("SELECT vehicle_id, technician_id, status FROM repair_orders WHERE id = ?", (order_id,)).fetchone()
+        if not order or order[2] != 'OPEN':
+            raise ValueError(f"La orden {order_id} no está abierta")
+        lines = cur.execute(
+            "SELECT id, product_id, qty FROM repair_order_lines WHERE order_id = ? AND status = 'RESERVED'",
+            (order_id,)
+        ).fetchall()
+
+        needed = {}
+        for _, pid, qty in lines:
+            needed[pid] = needed.get(pid, 0) + qty
+        ids = list(needed)
+        levels = _stock_levels(cur.execute(_product_stock_sql(len(ids)), ids).fetchall()) if ids else {}
+        missing = []
+        for pid, qty in needed.items():
+            physical, reserved = levels.get(pid, (0, 0))
+            # las reservas de esta orden ya están incluidas en reserved
+            if physical - (reserved - qty) < qty:
+                missing.append(f"producto {pid}: físico {physical}, reservado por otras {reserved - qty}, requiere {qty}")
+        if missing:
+            raise StockError("; ".join(missing))
+
+        now = datetime.now().isoformat()
+        for line_id, pid, qty in lines:
+            cur.execute(
+                "INSERT INTO inventory_movements (product_id, qty, movement_type, date, vehicle_id, technician_id, reference, note) VALUES (?,?,'OUT',?,?,?,?,?)",
+                (pid, qty, now, order[0], order[1], f"OR-{order_id}", 'Asignación de orden')
+            )
+            cur.execute("UPDATE repair_order_lines SET status = 'ALLOCATED', movement_id = ? WHERE id = ?", (cur.lastrowid, line_id))
+        cur.execute("UPDATE repair_orders SET status = 'ALLOCATED' WHERE id = ?", (order_id,))
+    return len(lines)
+
+def finish_repair_order(db: DB, order_id: int):
+    """Finaliza la orden; las reservas que no se asignaron se liberan."""
+    with db.transaction() as cur:
+        cur.execute("UPDATE repair_order_lines SET status = 'RELEASED' WHERE order_id = ? AND status = 'RESERVED'", (order_id,))
+        cur.execute("UPDATE repair_orders SET status = 'FINISHED' WHERE id = ? AND status IN ('OPEN','ALLOCATED')", (order_id,))
+
+def cancel_repair_order(db: DB, order_id: int):
+    """Cancela la orden y libera sus reservas pendientes."""
+    with db.transaction() as cur:
+        cur.execute("UPDATE repair_order_lines SET status = 'RELEASED' WHERE order_id = ? AND status = 'RESERVED'", (order_id,))
+        cur.execute("UPDATE repair_orders SET status = 'CANCELED' WHERE id = ? AND status = 'OPEN'", (order_id,))
+
+# ---------------------- Valorización ----------------------
+
+# precio de proveedor vigente a una fecha; si no hay uno anterior, el primero conocido
+SUPPLIER_PRICE_SQL = '''COALESCE(
+    (SELECT sp.price FROM supplier_prices sp
+     WHERE sp.product_id = {pid} AND sp.date <= {date} ORDER BY sp.date DESC LIMIT 1),
+    (SELECT sp.price FROM supplier_prices sp
+     WHERE sp.product_id = {pid} ORDER BY sp.date LIMIT 1)
+)'''
+
+def update_valuation(db: DB, batch_size=VALUATION_BATCH, max_batches=None):
+    """Valoriza solo los movimientos nuevos (id > último procesado) con costo
+    promedio ponderado. Las entradas toman el precio de proveedor vigente a su
+    fecha; las salidas, el último promedio conocido. Con stock negativo se
+    mantiene value = qty * promedio, y la entrada que vuelve a dejar stock
+    positivo fija el promedio en su precio.
+    Procesa de a batch_size movimientos, con un commit por lote para no retener
+    el bloqueo de escritura (la primera pasada sobre una base existente recorre
+    todo el historial). Devuelve la cantidad procesada.
+    """
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        done = _update_valuation_batch(db, batch_size)
+        total += done
+        batches += 1
+        if done < batch_size:
+            break
+    return total
+
+def _update_valuation_batch(db: DB, batch_size):
+    with db.transaction(immediate=True) as cur:
+        row = cur.execute("SELECT last_movement_id FROM valuation_state WHERE id = 1").fetchone()
+        last_id = row[0] if row else 0
+        moves = cur.execute(f'''
+            SELECT im.id, im.product_id, im.qty, im.movement_type, im.date, im.is_opening, im.vehicle_id,
+                   CASE WHEN im.movement_type = 'IN' THEN {SUPPLIER_PRICE_SQL.format(pid='im.product_id', date='im.date')} END AS price
+            FROM inventory_movements im WHERE im.id > ? ORDER BY im.id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not moves:
+            return 0
+
+        state = {r[0]: (r[1], r[2], r[3]) for r in cur.execute(
+            "SELECT product_id, qty, value, avg_cost FROM product_valuation "
+            "WHERE product_id IN (SELECT DISTINCT product_id FROM inventory_movements WHERE id > ? AND id <= ?)",
+            (last_id, moves[-1][0])
+        )}
+        costs = []
+        for mid, pid, qty, mtype, date, is_opening, vehicle_id, price in moves:
+            if is_opening:
+                # saldo de un periodo archivado: ya fue valorizado antes de archivar
+                continue
+            q, v, avg = state.get(pid, (0, 0.0, None))
+            v_before = v
+            if avg is None:
+                # producto sin historial de costo: el precio de proveedor es la mejor referencia
+                if mtype != 'IN':
+                    price = cur.execute(
+                        "SELECT " + SUPPLIER_PRICE_SQL.format(pid='?1', date='?2'), (pid, date)
+                    ).fetchone()[0]
+                avg = price or 0.0
+            if mtype == 'IN':
+                unit = price if price is not None else avg
+                if q >= 0:
+                    v += unit * qty
+                    q += qty
+                    avg = v / q if q > 0 else avg
+                else:
+                    # el faltante ya salió al promedio anterior; si vuelve a haber stock
+                    # las unidades que quedan son de esta entrada
+                    q += qty
+                    if q > 0:
+                        avg = unit
+                    v = q * avg
+            else:
+                unit = avg
+                q -= qty
+                v = q * avg
+            state[pid] = (q, v, avg)
+            costs.append((mid, pid, date, unit, unit * qty, v - v_before, mtype, vehicle_id))
+
+        cur.executemany(
+            "INSERT OR REPLACE INTO movement_costs (movement_id, product_id, date, unit_cost, total_cost, value_delta, movement_type, vehicle_id) "
+            "VALUES (?,?,?,?,?,?,?,?)",
+            costs
+        )
+        touched = {c[1] for c in costs}
+        cur.executemany(
+            "INSERT OR REPLACE INTO product_valuation (product_id, qty, value, avg_cost) VALUES (?,?,?,?)",
+            [(pid, q, v, avg) for pid, (q, v, avg) in state.items() if pid in touched]
+        )
+        cur.execute("INSERT OR REPLACE INTO valuation_state (id, last_movement_id) VALUES (1, ?)", (moves[-1][0],))
+    return len(moves)
+
+def inventory_value(db: DB):
+    """Valor actual del inventario: (total, filas por producto).
+    Refleja lo valorizado hasta ahora: llamar antes a update_valuation.
+    """
+    rows = db.query(
+        "SELECT p.code, p.name, pv.qty, pv.avg_cost, pv.value FROM product_valuation pv "
+        "JOIN products p ON pv.product_id = p.id WHERE pv.qty != 0 ORDER BY pv.value DESC"
+    )
+    return sum(r['value'] for r in rows), rows
+
+def valuation_as_of(db: DB, date: str):
+    """Valor del inventario al cierre de una fecha (ISO, exclusiva): suma de las
+    variaciones de valor de los movimientos anteriores. En periodos archivados
+    solo quedan totales mensuales, así que ahí la fecha se redondea al 1° del mes.
+    """
+    rows = db.query(
+        "SELECT (SELECT COALESCE(SUM(value_delta), 0) FROM valuation_month_delta WHERE month < substr(?1, 1, 7)) "
+        "     + (SELECT COALESCE(SUM(value_delta), 0) FROM movement_costs WHERE date < ?1)",
+        (date,)
+    )
+    return rows[0][0] or 0.0
+
+def parts_cost_by_vehicle(db: DB, date_from=None):
+    """Costo de repuestos consumidos (OUT) por vehículo: salidas valorizadas vivas
+    más los totales mensuales de los periodos archivados (para estos, date_from
+    se aplica por mes).
+    """
+    live = "SELECT vehicle_id, 1 AS lines, total_cost AS cost FROM movement_costs WHERE movement_type = 'OUT' AND vehicle_id IS NOT NULL"
+    archived = "SELECT vehicle_id, lines, cost FROM archived_vehicle_costs"
+    params = ()
+    if date_from:
+        live += " AND date >= ?"
+        archived += " WHERE month >= substr(?, 1, 7)"
+        params = (date_from, date_from)
+    sql = (
+        "SELECT v.plate, SUM(c.lines) AS lines, SUM(c.cost) AS cost "
+        f"FROM ({live} UNION ALL {archived}) c JOIN vehicles v ON c.vehicle_id = v.id "
+        "GROUP BY c.vehicle_id ORDER BY cost DESC"
+    )
+    return db.query(sql, params)
+
+# ---------------------- Pronóstico de consumo ----------------------
+
+class StockoutForecast(_Record):
+    __slots__ = ('product_id', 'code', 'name', 'available', 'daily_rate', 'days_left', 'stockout_date', 'lead_time', 'at_risk')
+
+def load_daily_out(db: DB, start, days):
+    """Serie diaria de salidas (OUT) de todos los productos desde start, en una matriz
+    (productos con consumo x días). Incluye los archivos anuales que cubren el periodo.
+    Cada fuente devuelve un único texto 'producto,día,cantidad,...' que numpy
+    convierte de una vez, sin crear una fila Python por movimiento.
+    """
+    years = [y for y in list_archive_years() if y >= start.year]
+    # NOT INDEXED: el periodo abarca casi toda la tabla viva (lo antiguo está archivado),
+    # un recorrido secuencial es más rápido que ir por idx_movements_date
+    sql = (
+        "SELECT group_concat(product_id || ',' || CAST(julianday(substr(date, 1, 10)) - julianday(?) AS INTEGER) || ',' || qty) "
+        "FROM {src}.inventory_movements NOT INDEXED "
+        "WHERE movement_type = 'OUT' AND date >= ? AND is_opening = 0"
+    )
+    params = (start.isoformat(), start.isoformat())
+
+    chunks = []
+    for n, group in enumerate(archive_chunks(db, years) or [[]]):
+        with attached_archives(db, group):
+            for src in (["main"] if n == 0 else []) + [f"arch_{y}" for y in group]:
+                text = db.query(sql.format(src=src), params)[0][0]
+                if text:
+                    chunks.append(np.fromstring(text, dtype=np.int64, sep=',').reshape(-1, 3))
+
+    if not chunks:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, days), dtype=np.float32)
+    data = np.concatenate(chunks)
+    data = data[(data[:, 1] >= 0) & (data[:, 1] < days)]
+    product_ids, row_idx = np.unique(data[:, 0], return_inverse=True)
+    demand = np.zeros((len(product_ids), days), dtype=np.float32)
+    np.add.at(demand, (row_idx, data[:, 1]), data[:, 2])
+    return product_ids, demand
+
+def forecast_daily_rate(demand, method='ses', alpha=FORECAST_ALPHA):
+    """Consumo diario esperado por fila.
+    - 'ses': suavizado exponencial simple, calculado como un único producto matricial
+      con los pesos alpha * (1 - alpha)^k (el más reciente pesa más)
+    - 'ma': promedio móvil de los últimos FORECAST_MA_DAYS días
+    """
+    if method == 'ma':
+        return demand[:, -FORECAST_MA_DAYS:].mean(axis=1)
+    days = demand.shape[1]
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1, dtype=np.float64)
+    # nivel inicial = media del periodo, con el peso remanente (1 - alpha)^days
+    level0 = demand.mean(axis=1) * (1 - alpha) ** days
+    return demand.astype(np.float64) @ weights + level0
+
+def forecast_stockouts(db: DB, method='ses', history_days=FORECAST_HISTORY_DAYS, today=None):
+    """Fecha estimada de quiebre de stock para cada producto con consumo.
+    at_risk = se agota antes de que llegue una reposición pedida hoy (lead time).
+    Devuelve una lista de StockoutForecast ordenada por días restantes.
+    """
+    today = today or datetime.now().date()
+    # la última columna de la matriz es hoy
+    start = today - timedelta(days=history_days - 1)
+    product_ids, demand = load_daily_out(db, start, history_days)
+    if not len(product_ids):
+        return []
+    rate = forecast_daily_rate(demand, method)
+
+    levels = get_stock_levels(db)
+    # mismo criterio que estimate_delivery_date: promedio de proveedores, o el del producto
+    supplier_lt = {r[0]: r[1] for r in db.query(
+        "SELECT sp.product_id, AVG(s.lead_time_days) FROM supplier_prices sp JOIN suppliers s ON sp.supplier_id = s.id "
+        "WHERE s.lead_time_days IS NOT NULL GROUP BY sp.product_id"
+    )}
+    catalog = db.catalog
+    available = np.empty(len(product_ids), dtype=np.float64)
+    lead_time = np.empty(len(product_ids), dtype=np.float64)
+    for i, pid in enumerate(product_ids.tolist()):
+        physical, reserved = levels.get(pid, (0, 0))
+        available[i] = physical - reserved
+        if pid in supplier_lt:
+            lead_time[i] = supplier_lt[pid]
+        else:
+            prod = catalog.product(pid)
+            lead_time[i] = (prod.lead_time_days if prod else None) or 7
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_left = np.where(rate > 0, np.maximum(available, 0) / rate, np.inf)
+    at_risk = days_left < np.round(lead_time)
+
+    result = []
+    for i in np.argsort(days_left, kind='stable'):
+        pid = int(product_ids[i])
+        prod = catalog.product(pid)
+        finite = days_left[i] <= FORECAST_HORIZON_DAYS
+        result.append(StockoutForecast(
+            pid,
+            prod.code if prod else None,
+            prod.name if prod else f"#{pid}",
+            int(available[i]),
+            float(rate[i]),
+            float(days_left[i]) if finite else None,
+            today + timedelta(days=int(days_left[i])) if finite else None,
+            int(round(lead_time[i])),
+            bool(at_risk[i]),
+        ))
+    return result
+
+# ---------------------- Archivo histórico ----------------------
+
+def archive_path(year):
+    return os.path.join(ARCHIVE_DIR, f"movimientos_{year}.db")
+
+def list_archive_years():
+    """Años con base de archivo que realmente contiene la tabla de movimientos."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    years = []
+    for name in os.listdir(ARCHIVE_DIR):
+        m = re.fullmatch(r"movimientos_(\d{4})\.db", name)
+        if not m:
+            continue
+        try:
+            conn = sqlite3.connect(f"file:{os.path.join(ARCHIVE_DIR, name)}?mode=ro", uri=True)
+            try:
+                ok = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='inventory_movements'").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            ok = None
+        if ok:
+            years.append(int(m.group(1)))
+    return sorted(years)
+
+def archive_chunks(db: DB, years):
+    """Divide los años en grupos que entran en el límite de ATTACH de sqlite (10 por defecto)."""
+    size = db.conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(db.conn, 'getlimit') else 10
+    years = list(years)
+    return [years[i:i + size] for i in range(0, len(years), size)]
+
+@contextmanager
+def attached_archives(db: DB, years):
+    """ATTACH de las bases anuales (fuera de transacción, como exige sqlite).
+    Al salir se hace DETACH solo de las que llegaron a adjuntarse.
+    """
+    attached = []
+    try:
+        for y in years:
+            db.query(f"ATTACH DATABASE ? AS arch_{int(y)}", (archive_path(y),))
+            attached.append(int(y))
+        yield attached
+    finally:
+        for y in attached:
+            db.query(f"DETACH DATABASE arch_{y}")
+
+def archive_movements(db: DB, up_to_year: int):
+    """Cierra los periodos hasta el 31/12 de up_to_year:
+    - copia sus movimientos a archivo/movimientos_<año>.db (una base por año)
+    - los borra de la tabla viva
+    - deja un movimiento de saldo inicial (is_opening = 1) por producto al 1/1 siguiente
+    - resume sus costos (movement_costs) en totales mensuales
+    La copia se hace por grupos de años (límite de ATTACH) y es idempotente; el
+    borrado y los saldos van en una transacción aparte cuando todo está copiado.
+    Devuelve la cantidad de movimientos archivados.
+    """
+    cutoff = f"{int(up_to_year) + 1}-01-01"
+    rows = db.query("SELECT MAX(id) FROM inventory_movements WHERE date < ?", (cutoff,))
+    max_id = rows[0][0]
+    if max_id is None:
+        return 0
+    years = [int(r[0]) for r in db.query(
+        "SELECT DISTINCT substr(date, 1, 4) FROM inventory_movements WHERE date < ? AND id <= ?", (cutoff, max_id)
+    )]
+
+    # lo archivado queda fuera de la tabla viva: valorizarlo antes
+    update_valuation(db)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    for chunk in archive_chunks(db, years):
+        with attached_archives(db, chunk):
+            with db.transaction(immediate=True) as cur:
+                for y in chunk:
+                    cur.execute(f'''
+                        CREATE TABLE IF NOT EXISTS arch_{y}.inventory_movements (
+                            id INTEGER PRIMARY KEY,
+                            product_id INTEGER,
+                            qty INTEGER,
+                            movement_type TEXT,
+                            date TEXT,
+                            vehicle_id INTEGER,
+                            technician_id INTEGER,
+                            reference TEXT,
+                            note TEXT,
+                            is_opening INTEGER DEFAULT 0
+                        )
+                    ''')
+                    cur.execute(f"CREATE INDEX IF NOT EXISTS arch_{y}.idx_movements_date ON inventory_movements(date)")
+                    cur.execute(f"CREATE INDEX IF NOT EXISTS arch_{y}.idx_movements_vehicle ON inventory_movements(vehicle_id, movement_type, date)")
+                    cur.execute(
+                        f"INSERT OR REPLACE INTO arch_{y}.inventory_movements ({MOVEMENT_COLUMNS}) "
+                        f"SELECT {MOVEMENT_COLUMNS} FROM main.inventory_movements WHERE date < ? AND id <= ? AND substr(date, 1, 4) = ?",
+                        (cutoff, max_id, str(y))
+                    )
+
+    with db.transaction(immediate=True) as cur:
+        # saldos al cierre, antes de borrar
+        balances = cur.execute(
+            "SELECT product_id, SUM(CASE WHEN movement_type='IN' THEN qty WHEN movement_type='OUT' THEN -qty ELSE 0 END) "
+            "FROM inventory_movements WHERE date < ? AND id <= ? GROUP BY product_id",
+            (cutoff, max_id)
+        ).fetchall()
+        cur.execute("DELETE FROM inventory_movements WHERE date < ? AND id <= ?", (cutoff, max_id))
+        archived = cur.rowcount
+
+        cur.execute(
+            "INSERT INTO valuation_month_delta (month, value_delta) "
+            "SELECT substr(date, 1, 7), SUM(value_delta) FROM movement_costs "
+            "WHERE date < ? AND movement_id <= ? GROUP BY substr(date, 1, 7) "
+            "ON CONFLICT(month) DO UPDATE SET value_delta = value_delta + excluded.value_delta",
+            (cutoff, max_id)
+        )
+        cur.execute(
+            "INSERT INTO archived_vehicle_costs (vehicle_id, month, lines, cost) "
+            "SELECT vehicle_id, substr(date, 1, 7), COUNT(*), SUM(total_cost) FROM movement_costs "
+            "WHERE date < ? AND movement_id <= ? AND movement_type = 'OUT' AND vehicle_id IS NOT NULL "
+            "GROUP BY vehicle_id, substr(date, 1, 7) "
+            "ON CONFLICT(vehicle_id, month) DO UPDATE SET lines = lines + excluded.lines, cost = cost + excluded.cost",
+            (cutoff, max_id)
+        )
+        cur.execute("DELETE FROM movement_costs WHERE date < ? AND movement_id <= ?", (cutoff, max_id))
+
+        opening = [
+            (pid, abs(bal), 'IN' if bal > 0 else 'OUT', f"{cutoff}T00:00:00", OPENING_REF, f"Saldo al cierre de {up_to_year}", 1)
+            for pid, bal in balances if bal
+        ]
+        cur.executemany(
+            "INSERT INTO inventory_movements (product_id, qty, movement_type, date, reference, note, is_opening) VALUES (?,?,?,?,?,?,?)",
+            opening
+        )
+    return archived
+
+def query_movements_history(db: DB, date_from=None, date_to=None, limit=500):
+    """Movimientos entre date_from (incl.) y date_to (excl.), uniendo la tabla viva
+    con las bases anuales que cubren el rango. Los saldos iniciales se omiten
+    porque los movimientos originales ya están en los archivos.
+    """
+    years = [
+        y for y in list_archive_years()
+        if (date_from is None or y >= int(date_from[:4])) and (date_to is None or y <= int(date_to[:4]))
+    ]
+    cond = ["is_opening = 0"]
+    params = []
+    if date_from:
+        cond.append("date >= ?")
+        params.append(date_from)
+    if date_to:
+        cond.append("date < ?")
+        params.append(date_to)
+    where = " AND ".join(cond)
+
+    # un UNION por grupo de años adjuntos; la tabla viva va con el primero
+    rows = []
+    for n, chunk in enumerate(archive_chunks(db, years) or [[]]):
+        sources = (["main"] if n == 0 else []) + [f"arch_{y}" for y in chunk]
+        union = " UNION ALL ".join(f"SELECT {MOVEMENT_COLUMNS} FROM {src}.inventory_movements WHERE {where}" for src in sources)
+        sql = (
+            f"SELECT m.*, p.name as product FROM ({union}) m LEFT JOIN products p ON m.product_id=p.id "
+            "ORDER BY m.date DESC LIMIT ?"
+        )
+        with attached_archives(db, chunk):
+            rows += db.query(sql, tuple(params) * len(sources) + (limit,))
+    rows.sort(key=lambda r: r['date'], reverse=True)
+    return rows[:limit]
+
+# ---------------------- Clientes y vehículos ----------------------
+
+def prefix_bounds(prefix):
+    """Rango [desde, hasta) equivalente a LIKE 'prefix%' que sí usa el índice."""
+    prefix = prefix.strip()
+    return prefix, prefix + '\U0010ffff'
+
+def add_customer(db: DB, name, phone='', email='', note=''):
+    return db.query(
+        "INSERT INTO customers (name, phone, email, note) VALUES (?,?,?,?)",
+        (name, phone, email, note),
+        commit=True
+    )
+
+def add_vehicle(db: DB, plate, customer_id=None):
+    """Alta de vehículo; owner se mantiene con el nombre del cliente por compatibilidad."""
+    owner = ''
+    if customer_id is not None:
+        rows = db.query("SELECT name FROM customers WHERE id = ?", (customer_id,))
+        owner = rows[0]['name'] if rows else ''
+    return db.query(
+        "INSERT INTO vehicles (plate, owner, customer_id) VALUES (?,?,?)",
+        (plate.strip().upper(), owner, customer_id),
+        commit=True
+    )
+
+def search_customers(db: DB, prefix, limit=50):
+    lo, hi = prefix_bounds(prefix)
+    return db.query(
+        "SELECT * FROM customers WHERE name >= ? COLLATE NOCASE AND name < ? COLLATE NOCASE "
+        "ORDER BY name COLLATE NOCASE LIMIT ?",
+        (lo, hi, limit)
+    )
+
+def search_vehicles(db: DB, prefix, limit=50):
+    lo, hi = prefix_bounds(prefix)
+    return db.query(
+        "SELECT v.id, v.plate, v.owner, v.customer_id, c.name AS customer FROM vehicles v "
+        "LEFT JOIN customers c ON v.customer_id = c.id "
+        "WHERE v.plate >= ? COLLATE NOCASE AND v.plate < ? COLLATE NOCASE "
+        "ORDER BY v.plate COLLATE NOCASE LIMIT ?",
+        (lo, hi, limit)
+    )
+
+def customer_vehicles(db: DB, customer_ids):
+    """Vehículos de varios clientes en una sola consulta: {customer_id: [filas]}."""
+    customer_ids = list(customer_ids)
+    result = {}
+    if not customer_ids:
+        return result
+    rows = db.query(
+        f"SELECT id, plate, customer_id FROM vehicles WHERE customer_id IN ({','.join('?' * len(customer_ids))}) ORDER BY plate",
+        customer_ids
+    )
+    for r in rows:
+        result.setdefault(r['customer_id'], []).append(r)
+    return result
+
+def vehicle_history(db: DB, vehicle_id, before=None, limit=50):
+    """Repuestos consumidos (OUT) por un vehículo, del más reciente al más antiguo.
+    Paginación por cursor: before = (date, id) de la última fila de la página anterior.
+    Si la tabla viva no completa la página se sigue con los archivos anuales.
+    """
+    def page(src, remaining):
+        sql = (
+            f"SELECT im.id, im.date, im.qty, im.reference, im.note, p.code, p.name AS product, t.name AS tech "
+            f"FROM {src}.inventory_movements im "
+            "LEFT JOIN products p ON im.product_id = p.id LEFT JOIN technicians t ON im.technician_id = t.id "
+            "WHERE im.vehicle_id = ? AND im.movement_type = 'OUT'"
+        )
+        params = [vehicle_id]
+        if before:
+            sql += " AND (im.date, im.id) < (?, ?)"
+            params += list(before)
+        sql += " ORDER BY im.date DESC, im.id DESC LIMIT ?"
+        params.append(remaining)
+        return db.query(sql, params)
+
+    rows = list(page("main", limit))
+    if len(rows) >= limit:
+        return rows
+
+    years = [y for y in reversed(list_archive_years()) if not before or y <= int(before[0][:4])]
+    # un año a la vez (límite de ATTACH), del más reciente al más antiguo
+    for y in years:
+        with attached_archives(db, [y]):
+            rows += page(f"arch_{y}", limit - len(rows))
+        if len(rows) >= limit:
+            break
+    return rows
+
+# ---------------------- Escaneo rápido ----------------------
+
+class ScanQueue:
+    """Cola de movimientos escaneados; se graban por lotes en una sola transacción."""
+    def __init__(self, db: DB):
+        self.db = db
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def put(self, product_id, qty, movement_type, vehicle_id=None, technician_id=None, reference=''):
+        with self.lock:
+            self.pending.append((product_id, qty, movement_type, datetime.now().isoformat(), vehicle_id, technician_id, reference, 'Escaneo'))
+            return len(self.pending)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            with self.db.transaction() as cur:
+                cur.executemany(
+                    "INSERT INTO inventory_movements (product_id, qty, movement_type, date, vehicle_id, technician_id, reference, note) VALUES (?,?,?,?,?,?,?,?)",
+                    batch
+                )
+        except Exception:
+            # p.ej. 'database is locked': devolver el lote a la cola para el próximo intento
+            with self.lock:
+                self.pending = batch + self.pending
+            raise
+        return len(batch)
+
+def parse_scan(text):
+    """Lectura del escáner: 'CODIGO' o 'N*CODIGO' para varias unidades.
+    '0*CODIGO' devuelve cantidad 0: on_scan la rechaza.
+    """
+    text = text.strip()
+    qty = 1
+    if '*' in text:
+        head, tail = text.split('*', 1)
+        if head.strip().isdigit():
+            qty = int(head)
+            text = tail.strip()
+    return text, qty
+
 # ---------------------- Interfaz Grafica ----------------------
 
 class TallerApp(ctk.CTk):
     def __init__(self, db: DB):
         super().__init__()
         self.db = db
+        self.db.catalog.warm()
+        self.scans = ScanQueue(db)
+        self.scan_vehicle_id = None
+        self.scan_vehicle_plate = None
+        self.scan_dirty = False
+        self.last_scan = 0.0
+        self.forecast = {}
+        self.forecast_job = None
+        self.archive_job = None
+        self.valuation_job = None
         self.title("Registro Taller - Inventario y Control")
         self.geometry("1000x700")
         ctk.set_appearance_mode("System")
@@ -189,6 +1173,10 @@ class TallerApp(ctk.CTk):
         self.build_reports_tab()
 
         self.refresh_all()
+        self.refresh_valuation()
+        self.refresh_forecast()
+        self.after(SCAN_FLUSH_MS, self.scan_flush_loop)
+        self.after(CATALOG_CHECK_MS, self.catalog_check_loop)
 
     # ----------------- Productos -----------------
     def build_product_tab(self):
@@ -272,21 +1260,22 @@ class TallerApp(ctk.CTk):
                 w.destroy()
 
     def refresh_products(self):
+        self.db.catalog.check()
         for widget in self.products_list.winfo_children():
             widget.destroy()
-        rows = self.db.query("SELECT * FROM products ORDER BY name")
-        for r in rows:
-            pid = r[0]
-            name = r[2]
-            code = r[1]
-            unit = r[3]
+        levels = get_stock_levels(self.db)
+        for r in self.db.catalog.products():
+            pid = r.id
+            name = r.name
+            code = r.code
+            unit = r.unit
             frame = ctk.CTkFrame(self.products_list)
             frame.pack(fill='x', padx=6, pady=4)
             ctk.CTkLabel(frame, text=f"{code} — {name} ({unit})").grid(row=0, column=0, sticky='w')
             ctk.CTkButton(frame, text="Editar", width=70, command=lambda pid=pid: self.load_product_into_form(pid)).grid(row=0, column=1, padx=6)
             ctk.CTkButton(frame, text="Eliminar", width=70, command=lambda pid=pid: self.delete_product(pid)).grid(row=0, column=2, padx=6)
-            stock = get_stock(self.db, pid)
-            ctk.CTkLabel(frame, text=f"Stock: {stock}").grid(row=1, column=0, sticky='w', pady=4)
+            stock, reserved = levels.get(pid, (0, 0))
+            ctk.CTkLabel(frame, text=f"Stock: {stock} — Disponible: {stock - reserved}").grid(row=1, column=0, sticky='w', pady=4)
 
     def load_product_into_form(self, product_id):
         row = self.db.query("SELECT * FROM products WHERE id = ?", (product_id,))
@@ -335,6 +1324,14 @@ class TallerApp(ctk.CTk):
         self.m_note.pack(pady=6)
         ctk.CTkButton(left, text='Registrar', command=self.add_movement).pack(pady=8)
 
+        # Modo escaneo: el lector (teclado) envía el código seguido de Enter
+        ctk.CTkLabel(left, text='Modo escaneo (código o placa)', font=ctk.CTkFont(size=14, weight='bold')).pack(pady=(12, 4))
+        self.scan_entry = ctk.CTkEntry(left, placeholder_text='Escanear... (N*CODIGO para cantidad)', width=300)
+        self.scan_entry.pack(pady=4)
+        self.scan_entry.bind('<Return>', self.on_scan)
+        self.scan_status = ctk.CTkLabel(left, text='Vehículo: - | Pendientes: 0')
+        self.scan_status.pack(pady=4)
+
         right = ctk.CTkFrame(frame)
         right.pack(side='left', fill='both', expand=True, padx=8, pady=8)
         ctk.CTkLabel(right, text='Últimos Movimientos', font=ctk.CTkFont(size=16, weight='bold')).pack(pady=6)
@@ -362,11 +1359,11 @@ class TallerApp(ctk.CTk):
         try:
             product_id = int(prod_display.split('|')[0])
         except Exception:
-            # fallback: try mapping by code
-            rows = self.db.query("SELECT id FROM products WHERE name = ?", (prod_display,))
-            if not rows:
+            # fallback: try mapping by name, then by code
+            prod = self.db.catalog.product_by_name(prod_display) or self.db.catalog.product_by_code(prod_display)
+            if prod is None:
                 return
-            product_id = rows[0]['id']
+            product_id = prod.id
 
         mtype = self.m_type.get()
         try:
@@ -394,12 +1391,74 @@ class TallerApp(ctk.CTk):
             (product_id, qty, mtype, datetime.now().isoformat(), vehicle_id, tech_id, ref, note),
             commit=True
         )
+        self.refresh_valuation()
 
         # Refresh UI
         self.refresh_movements()
         self.refresh_products()
         self.refresh_inventory()
 
+    def on_scan(self, event=None):
+        text, qty = parse_scan(self.scan_entry.get())
+        self.scan_entry.delete(0, 'end')
+        if not text:
+            return
+        if qty <= 0:
+            self.scan_status.configure(text=f"Cantidad inválida: {qty} x {text} | Pendientes: {len(self.scans.pending)}")
+            return
+        self.last_scan = time.monotonic()
+        hit = self.db.catalog.lookup(text)
+        if hit is None:
+            self.scan_status.configure(text=f"Código desconocido: {text} | Pendientes: {len(self.scans.pending)}")
+            return
+        kind, ident = hit
+        if kind == 'vehicle':
+            self.scan_vehicle_id = ident
+            self.scan_vehicle_plate = normalize_code(text)
+            self.scan_status.configure(text=f"Vehículo: {self.scan_vehicle_plate} | Pendientes: {len(self.scans.pending)}")
+            return
+
+        tech_id = None
+        if self.m_technician.get():
+            try:
+                tech_id = int(self.m_technician.get().split('|')[0])
+            except Exception:
+                tech_id = None
+        pending = self.scans.put(ident, qty, self.m_type.get(), self.scan_vehicle_id, tech_id, self.m_ref.get().strip())
+        if pending >= SCAN_BATCH_SIZE:
+            self.flush_scans()
+        else:
+            self.scan_status.configure(text=f"Último: {qty} x {text} | Pendientes: {pending}")
+
+    def flush_scans(self):
+        try:
+            written = self.scans.flush()
+        except Exception as e:
+            self.scan_status.configure(text=f"Error al grabar (se reintenta): {e} | Pendientes: {len(self.scans.pending)}")
+            return
+        if written:
+            # la valorización y la lista se actualizan cuando el escáner queda quieto
+            self.scan_dirty = True
+            self.scan_status.configure(text=f"Vehículo: {self.scan_vehicle_plate or '-'} | Pendientes: {len(self.scans.pending)}")
+
+    def scan_flush_loop(self):
+        try:
+            self.flush_scans()
+            if self.scan_dirty and (time.monotonic() - self.last_scan) * 1000 >= SCAN_IDLE_MS:
+                self.scan_dirty = False
+                self.refresh_valuation()
+                # solo la lista de movimientos: los listados de stock se refrescan en la próxima acción
+                self.refresh_movements()
+        finally:
+            self.after(SCAN_FLUSH_MS, self.scan_flush_loop)
+
+    def catalog_check_loop(self):
+        # el escáner consulta el catálogo en memoria: ver cambios de otros procesos
+        try:
+            self.db.catalog.check()
+        finally:
+            self.after(CATALOG_CHECK_MS, self.catalog_check_loop)
+
     def refresh_movements(self):
         for w in self.movements_list.winfo_children():
             w.destroy()
@@ -500,14 +1559,14 @@ class TallerApp(ctk.CTk):
         self.refresh_suppliers()
 
     def refresh_suppliers(self):
+        self.db.catalog.check()
         for w in self.suppliers_list.winfo_children():
             w.destroy()
-        rows = self.db.query("SELECT * FROM suppliers ORDER BY name")
-        for r in rows:
-            sid = r['id']
+        for r in self.db.catalog.suppliers():
+            sid = r.id
             frame = ctk.CTkFrame(self.suppliers_list)
             frame.pack(fill='x', padx=6, pady=4)
-            ctk.CTkLabel(frame, text=f"{r['name']} (lead {r['lead_time_days']} días)").grid(row=0, column=0, sticky='w')
+            ctk.CTkLabel(frame, text=f"{r.name} (lead {r.lead_time_days} días)").grid(row=0, column=0, sticky='w')
             prices = self.db.query("SELECT sp.price, sp.date, p.name FROM supplier_prices sp JOIN products p ON sp.product_id=p.id WHERE sp.supplier_id=? ORDER BY sp.date DESC LIMIT 5", (sid,))
             for p in prices:
                 ctk.CTkLabel(frame, text=f"{p['name']}: {p['price']} @ {p['date'][:10]}").grid(row=1, column=0, sticky='w')
@@ -527,21 +1586,26 @@ class TallerApp(ctk.CTk):
         self.inv_qty = ctk.CTkEntry(bottom, placeholder_text='Cantidad')
         self.inv_qty.pack(side='left', padx=6)
         ctk.CTkButton(bottom, text='Estimar fecha', command=self.estimate_date_ui).pack(side='left', padx=6)
+        ctk.CTkButton(bottom, text='Actualizar pronóstico', command=self.refresh_forecast).pack(side='left', padx=6)
         self.estimate_label = ctk.CTkLabel(bottom, text='')
         self.estimate_label.pack(side='left', padx=12)
 
     def refresh_inventory(self):
+        self.db.catalog.check()
         for w in self.inventory_list.winfo_children():
             w.destroy()
-        rows = self.db.query("SELECT * FROM products ORDER BY name")
-        for r in rows:
-            pid = r['id']
-            name = r['name']
-            unit = r['unit']
-            stock = get_stock(self.db, pid)
+        levels = get_stock_levels(self.db)
+        for r in self.db.catalog.products():
+            pid = r.id
+            name = r.name
+            unit = r.unit
+            stock, reserved = levels.get(pid, (0, 0))
             frame = ctk.CTkFrame(self.inventory_list)
             frame.pack(fill='x', padx=6, pady=4)
-            txt = f"{name} ({unit}) — Stock: {stock} — Min: {r['min_stock'] or 0} — Lead default: {r['lead_time_days'] or 7}d"
+            txt = f"{name} ({unit}) — Stock: {stock} — Reservado: {reserved} — Min: {r.min_stock or 0} — Lead default: {r.lead_time_days or 7}d"
+            f = self.forecast.get(pid)
+            if f and f.stockout_date:
+                txt += f" — Se agota: {f.stockout_date}" + (" ⚠ antes de reposición" if f.at_risk else "")
             ctk.CTkLabel(frame, text=txt).pack(anchor='w')
 
     def estimate_date_ui(self):
@@ -555,9 +1619,90 @@ class TallerApp(ctk.CTk):
             return
         date, stock = estimate_delivery_date(self.db, prod_id, qty)
         if stock >= qty:
-            self.estimate_label.configure(text=f"En stock ({stock}) — entrega inmediata")
+            text = f"En stock ({stock}) — entrega inmediata"
         else:
-            self.estimate_label.configure(text=f"Stock actual {stock}. Fecha estimada llegada: {date}")
+            text = f"Stock actual {stock}. Fecha estimada llegada: {date}"
+        f = self.forecast.get(prod_id)
+        if f and f.stockout_date:
+            text += f" — Se agota aprox. {f.stockout_date}"
+        self.estimate_label.configure(text=text)
+
+    def refresh_forecast(self, on_done=None):
+        """Calcula el pronóstico en un hilo aparte (con su propia conexión) para no
+        congelar la ventana; el resultado se recoge en el hilo de la interfaz.
+        """
+        if self.forecast_job is not None:
+            # ya hay un cálculo en curso: avisar también a este llamador
+            if on_done:
+                self.forecast_job['callbacks'].append(on_done)
+            return
+        job = {'result': None, 'error': None, 'done': threading.Event(), 'callbacks': [on_done] if on_done else []}
+        self.forecast_job = job
+
+        def work():
+            bg = DB()
+            try:
+                job['result'] = forecast_stockouts(bg)
+            except Exception as e:
+                job['error'] = e
+            finally:
+                bg.close()
+                job['done'].set()
+
+        threading.Thread(target=work, daemon=True).start()
+        self.estimate_label.configure(text='Calculando pronóstico...')
+        self.after(FORECAST_POLL_MS, self.poll_forecast)
+
+    def poll_forecast(self):
+        job = self.forecast_job
+        if not job['done'].is_set():
+            self.after(FORECAST_POLL_MS, self.poll_forecast)
+            return
+        self.forecast_job = None
+        if job['error'] is not None:
+            self.estimate_label.configure(text=f"Error en pronóstico: {job['error']}")
+        else:
+            self.forecast = {f.product_id: f for f in job['result']}
+            at_risk = sum(1 for f in job['result'] if f.at_risk)
+            self.estimate_label.configure(text=f"Pronóstico actualizado: {at_risk} productos en riesgo")
+            self.refresh_inventory()
+        for callback in job['callbacks']:
+            callback()
+
+    def refresh_valuation(self, on_done=None):
+        """Valoriza los movimientos pendientes en un hilo aparte: la primera vez
+        sobre una base existente recorre todo el historial, por lotes.
+        """
+        if self.valuation_job is not None:
+            if on_done:
+                self.valuation_job['callbacks'].append(on_done)
+            return
+        job = {'error': None, 'done': threading.Event(), 'callbacks': [on_done] if on_done else []}
+        self.valuation_job = job
+
+        def work():
+            bg = DB()
+            try:
+                update_valuation(bg)
+            except Exception as e:
+                job['error'] = e
+            finally:
+                bg.close()
+                job['done'].set()
+
+        threading.Thread(target=work, daemon=True).start()
+        self.after(FORECAST_POLL_MS, self.poll_valuation)
+
+    def poll_valuation(self):
+        job = self.valuation_job
+        if not job['done'].is_set():
+            self.after(FORECAST_POLL_MS, self.poll_valuation)
+            return
+        self.valuation_job = None
+        if job['error'] is not None:
+            self.estimate_label.configure(text=f"Error en valorización: {job['error']}")
+        for callback in job['callbacks']:
+            callback()
 
     # ----------------- Reportes -----------------
     def build_reports_tab(self):
@@ -567,6 +1712,17 @@ class TallerApp(ctk.CTk):
         btns.pack(pady=6)
         ctk.CTkButton(btns, text='Movimientos recientes', command=self.report_movements).grid(row=0, column=0, padx=8)
         ctk.CTkButton(btns, text='Productos por debajo de mínimo', command=self.report_low_stock).grid(row=0, column=1, padx=8)
+        ctk.CTkButton(btns, text='Historial completo', command=self.report_history).grid(row=0, column=2, padx=8)
+        ctk.CTkButton(btns, text='Valorización', command=self.report_valuation).grid(row=0, column=3, padx=8)
+        ctk.CTkButton(btns, text='Costo por vehículo', command=self.report_vehicle_costs).grid(row=0, column=4, padx=8)
+        ctk.CTkButton(btns, text='Pronóstico de quiebre', command=self.report_forecast).grid(row=0, column=5, padx=8)
+
+        archive = ctk.CTkFrame(tab)
+        archive.pack(pady=6)
+        ctk.CTkLabel(archive, text='Archivar movimientos hasta el año:').grid(row=0, column=0, padx=8)
+        self.archive_year = ctk.CTkEntry(archive, placeholder_text=str(datetime.now().year - 2))
+        self.archive_year.grid(row=0, column=1, padx=8)
+        ctk.CTkButton(archive, text='Archivar', command=self.archive_ui).grid(row=0, column=2, padx=8)
         self.report_area = ctk.CTkTextbox(tab, height=400)
         self.report_area.pack(fill='both', expand=True, padx=8, pady=8)
 
@@ -577,31 +1733,126 @@ class TallerApp(ctk.CTk):
             dt = r['date'][:19].replace('T',' ')
             self.report_area.insert('end', f"[{dt}] {r['movement_type']} {r['qty']} x {r['product']} | Ref: {r['reference'] or '-'}\n")
 
-    def report_low_stock(self):
-        rows = self.db.query("SELECT * FROM products")
+    def report_history(self):
+        rows = query_movements_history(self.db, limit=2000)
         self.report_area.delete(1.0, 'end')
         for r in rows:
-            pid = r['id']
-            stock = get_stock(self.db, pid)
-            if stock <= (r['min_stock'] or 0):
-                self.report_area.insert('end', f"{r['code']} - {r['name']} : stock={stock} min={r['min_stock']}\n")
+            dt = r['date'][:19].replace('T',' ')
+            self.report_area.insert('end', f"[{dt}] {r['movement_type']} {r['qty']} x {r['product']} | Ref: {r['reference'] or '-'}\n")
+
+    def report_valuation(self):
+        self.report_area.delete(1.0, 'end')
+        self.report_area.insert('end', 'Actualizando valorización...\n')
+        self.refresh_valuation(on_done=self.show_valuation_report)
+
+    def show_valuation_report(self):
+        total, rows = inventory_value(self.db)
+        month_start = datetime.now().date().replace(day=1)
+        last_close = valuation_as_of(self.db, month_start.isoformat())
+        self.report_area.delete(1.0, 'end')
+        self.report_area.insert('end', f"Valor actual del inventario: {total:.2f}\n")
+        self.report_area.insert('end', f"Valor al cierre del mes anterior ({month_start - timedelta(days=1)}): {last_close:.2f}\n\n")
+        for r in rows:
+            self.report_area.insert('end', f"{r['code']} - {r['name']} : {r['qty']} x {r['avg_cost']:.2f} = {r['value']:.2f}\n")
+
+    def report_vehicle_costs(self):
+        self.report_area.delete(1.0, 'end')
+        self.report_area.insert('end', 'Actualizando valorización...\n')
+        self.refresh_valuation(on_done=self.show_vehicle_costs_report)
+
+    def show_vehicle_costs_report(self):
+        rows = parts_cost_by_vehicle(self.db)
+        self.report_area.delete(1.0, 'end')
+        for r in rows:
+            self.report_area.insert('end', f"{r['plate']} : {r['lines']} salidas, costo repuestos {r['cost']:.2f}\n")
+
+    def report_forecast(self):
+        self.report_area.delete(1.0, 'end')
+        self.report_area.insert('end', "Calculando pronóstico...\n")
+        self.refresh_forecast(on_done=self.show_forecast_report)
+
+    def show_forecast_report(self):
+        self.report_area.delete(1.0, 'end')
+        for f in self.forecast.values():
+            if f.stockout_date is None:
+                continue
+            flag = " ⚠ se agota antes de la reposición" if f.at_risk else ""
+            self.report_area.insert(
+                'end', f"{f.code} - {f.name} : disponible={f.available} consumo/día={f.daily_rate:.2f} "
+                       f"se agota {f.stockout_date} (lead {f.lead_time}d){flag}\n"
+            )
+
+    def archive_ui(self):
+        try:
+            year = int(self.archive_year.get().strip())
+        except ValueError:
+            return
+        if year >= datetime.now().year:
+            # solo se archivan años cerrados
+            return
+        if self.archive_job is not None:
+            # ya hay un archivado en curso
+            return
+        if not messagebox.askyesno(
+            'Archivar movimientos',
+            f"Se moverán a '{ARCHIVE_DIR}' todos los movimientos hasta el 31/12/{year} "
+            "y se dejará un saldo inicial por producto. ¿Continuar?"
+        ):
+            return
+        # igual que el pronóstico: hilo aparte con su propia conexión
+        job = {'year': year, 'result': None, 'error': None, 'done': threading.Event()}
+        self.archive_job = job
+
+        def work():
+            bg = DB()
+            try:
+                job['result'] = archive_movements(bg, year)
+            except Exception as e:
+                job['error'] = e
+            finally:
+                bg.close()
+                job['done'].set()
+
+        threading.Thread(target=work, daemon=True).start()
+        self.archive_year.delete(0, 'end')
+        self.report_area.delete(1.0, 'end')
+        self.report_area.insert('end', f"Archivando movimientos hasta {year}...\n")
+        self.after(FORECAST_POLL_MS, self.poll_archive)
+
+    def poll_archive(self):
+        job = self.archive_job
+        if not job['done'].is_set():
+            self.after(FORECAST_POLL_MS, self.poll_archive)
+            return
+        self.archive_job = None
+        self.report_area.delete(1.0, 'end')
+        if job['error'] is not None:
+            self.report_area.insert('end', f"Error al archivar: {job['error']}\n")
+            return
+        self.report_area.insert('end', f"{job['result']} movimientos archivados hasta {job['year']} en '{ARCHIVE_DIR}'\n")
+        self.refresh_movements()
+
+    def report_low_stock(self):
+        levels = get_stock_levels(self.db)
+        self.report_area.delete(1.0, 'end')
+        for r in self.db.catalog.products():
+            stock, reserved = levels.get(r.id, (0, 0))
+            if stock - reserved <= (r.min_stock or 0):
+                self.report_area.insert('end', f"{r.code} - {r.name} : stock={stock} reservado={reserved} min={r.min_stock}\n")
 
     # ----------------- Refresh helpers -----------------
     def refresh_movements_dropdowns(self):
-        prods = []
-        for r in self.db.query("SELECT id, code, name FROM products ORDER BY name"):
-            prods.append(f"{r['id']}|{r['code']} - {r['name']}")
+        catalog = self.db.catalog
+        catalog.check()
+        prods = catalog.choices('products')
         self.m_product.configure(values=prods)
         self.sp_product.configure(values=prods)
         self.inv_product.configure(values=prods)
 
-        vehicles = [f"{r['id']}|{r['plate']}" for r in self.db.query("SELECT id, plate FROM vehicles ORDER BY plate")]
-        self.m_vehicle.configure(values=vehicles)
-
-        techs = [f"{r['id']}|{r['name']}" for r in self.db.query("SELECT id, name FROM technicians ORDER BY name")]
-        self.m_technician.configure(values=techs)
+        self.m_vehicle.configure(values=catalog.choices('vehicles'))
+        self.m_technician.configure(values=catalog.choices('technicians'))
 
-        suppliers = [f"{r['id']}|{r['name']}" for r in self.db.query("SELECT id, name FROM suppliers ORDER BY name")]
+        suppliers = catalog.choices('suppliers')
         self.sp_supplier.configure(values=suppliers)
         self.sp_supplier.set('')
 
@@ -615,11 +1866,12 @@ class TallerApp(ctk.CTk):
 # ---------------------- Inicio ----------------------
 
 def main():
-    if not os.path.exists(DB_FILE):
-        init_db()
+    # init_db es idempotente: crea tablas e índices que falten en bases existentes
+    init_db()
     db = DB()
     app = TallerApp(db)
     app.mainloop()
+    app.scans.flush()
     db.close()
 
 if __name__ == '__main__':
@@ -3,12 +3,35 @@ from config import colors
 from PIL import Image
 import os
 
+from almacen import (
+    DB, init_db, StockError, get_stock_levels, create_repair_order, reserve_part,
+    allocate_order, finish_repair_order, cancel_repair_order,
+    add_customer, add_vehicle, search_customers, search_vehicles, customer_vehicles, vehicle_history,
+)
+
+HISTORY_PAGE = 50
+SEARCH_DEBOUNCE_MS = 250
+
 ctk.set_appearance_mode("light")
 ctk.set_default_color_theme("blue")
 
+# Estado de orden -> (texto, fondo, texto del badge)
+ORDER_BADGES = {
+    "OPEN": ("Abierta", colors.BADGE_IN_PROGRESS_BG, colors.BADGE_IN_PROGRESS_FG),
+    "ALLOCATED": ("Repuestos asignados", colors.BADGE_IN_PROGRESS_BG, colors.BADGE_IN_PROGRESS_FG),
+    "FINISHED": ("Finalizada", colors.BADGE_FINISHED_BG, colors.BADGE_FINISHED_FG),
+    "CANCELED": ("Cancelada", colors.BADGE_CANCELED_BG, colors.BADGE_CANCELED_FG),
+}
+
 class TallerApp(ctk.CTk):
-    def __init__(self):
+    def __init__(self, db: DB):
         super().__init__()
+        self.db = db
+        self.selected_order_id = None
+        self.selected_customer_id = None
+        self.history_vehicle_id = None
+        self.history_cursor = None
+        self.search_job = None
         self.title("Talleric - Sistema de Gestión")
         self.geometry("1100x650")
         self.minsize(1000, 600)
@@ -127,6 +150,10 @@ class TallerApp(ctk.CTk):
         self.active_button = btn
 
     def clear_main(self):
+        # una búsqueda pendiente apuntaría a widgets que se van a destruir
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+            self.search_job = None
         for widget in self.main_frame.winfo_children():
             widget.destroy()
 
@@ -143,14 +170,268 @@ class TallerApp(ctk.CTk):
         ctk.CTkLabel(
             self.main_frame, text="🧾 Órdenes de Reparación",
             font=("Roboto", 24, "bold"), text_color=colors.TEXT_PRIMARY
-        ).pack(pady=30)
+        ).pack(pady=(30, 10))
+
+        # Nueva orden
+        form = ctk.CTkFrame(self.main_frame, fg_color=colors.BG_LIGHT)
+        form.pack(fill="x", padx=20, pady=4)
+        self.db.catalog.check()
+        vehicles = self.db.catalog.choices("vehicles")
+        techs = self.db.catalog.choices("technicians")
+        self.o_vehicle = ctk.CTkComboBox(form, values=vehicles, width=180)
+        self.o_vehicle.set("")
+        self.o_vehicle.grid(row=0, column=0, padx=6, pady=6)
+        self.o_technician = ctk.CTkComboBox(form, values=techs, width=180)
+        self.o_technician.set("")
+        self.o_technician.grid(row=0, column=1, padx=6, pady=6)
+        self.o_note = ctk.CTkEntry(form, placeholder_text="Trabajo a realizar", width=260)
+        self.o_note.grid(row=0, column=2, padx=6, pady=6)
+        self.action_button(form, "Nueva orden", self.add_order).grid(row=0, column=3, padx=6, pady=6)
+
+        # Reservar repuesto en la orden seleccionada
+        levels = get_stock_levels(self.db)
+        products = []
+        for r in self.db.catalog.products():
+            physical, reserved = levels.get(r.id, (0, 0))
+            products.append(f"{r.id}|{r.code} - {r.name} (disp. {physical - reserved})")
+        self.o_product = ctk.CTkComboBox(form, values=products, width=360)
+        self.o_product.set("")
+        self.o_product.grid(row=1, column=0, columnspan=2, padx=6, pady=6)
+        self.o_qty = ctk.CTkEntry(form, placeholder_text="Cantidad", width=260)
+        self.o_qty.grid(row=1, column=2, padx=6, pady=6)
+        self.action_button(form, "Reservar repuesto", self.add_order_line).grid(row=1, column=3, padx=6, pady=6)
+
+        self.o_status = ctk.CTkLabel(self.main_frame, text="", text_color=colors.TEXT_SECONDARY)
+        self.o_status.pack(padx=20, anchor="w")
+
+        self.orders_list = ctk.CTkScrollableFrame(self.main_frame, fg_color="#FFFFFF")
+        self.orders_list.pack(fill="both", expand=True, padx=20, pady=(4, 20))
+        self.refresh_orders()
+
+    def action_button(self, parent, text, command):
+        return ctk.CTkButton(
+            parent, text=text, command=command,
+            fg_color=colors.BOTON_ACCION_BG, hover_color=colors.BOTON_ACCION_HOVER_BG,
+            text_color=colors.BOTON_ACCION_FG, font=("Roboto", 13)
+        )
+
+    def order_message(self, text, error=False):
+        self.o_status.configure(text=text, text_color=colors.BADGE_CANCELED_BG if error else colors.TEXT_SECONDARY)
+
+    @staticmethod
+    def combo_id(combo):
+        try:
+            return int(combo.get().split("|")[0])
+        except ValueError:
+            return None
+
+    def add_order(self):
+        order_id = create_repair_order(
+            self.db, self.combo_id(self.o_vehicle), self.combo_id(self.o_technician), self.o_note.get().strip()
+        )
+        self.selected_order_id = order_id
+        self.show_ordenes()
+        self.order_message(f"Orden #{order_id} creada")
+
+    def add_order_line(self):
+        product_id = self.combo_id(self.o_product)
+        if self.selected_order_id is None or product_id is None:
+            self.order_message("Selecciona una orden y un producto", error=True)
+            return
+        try:
+            qty = int(self.o_qty.get().strip())
+            reserve_part(self.db, self.selected_order_id, product_id, qty)
+        except (StockError, ValueError) as e:
+            self.order_message(f"No se pudo reservar: {e}", error=True)
+            return
+        self.show_ordenes()
+        self.order_message(f"Reservado {qty} en orden #{self.selected_order_id}")
+
+    def run_order_action(self, action, order_id, done_text):
+        try:
+            action(self.db, order_id)
+        except (StockError, ValueError) as e:
+            self.order_message(f"Orden #{order_id}: {e}", error=True)
+            return
+        self.show_ordenes()
+        self.order_message(f"Orden #{order_id} {done_text}")
+
+    def select_order(self, order_id):
+        self.selected_order_id = order_id
+        self.refresh_orders()
+        self.order_message(f"Orden #{order_id} seleccionada")
+
+    def refresh_orders(self):
+        for widget in self.orders_list.winfo_children():
+            widget.destroy()
+        orders = self.db.query(
+            "SELECT o.*, v.plate AS plate, t.name AS tech FROM repair_orders o "
+            "LEFT JOIN vehicles v ON o.vehicle_id = v.id LEFT JOIN technicians t ON o.technician_id = t.id "
+            "ORDER BY o.id DESC LIMIT 100"
+        )
+        lines = {}
+        if orders:
+            ids = [o["id"] for o in orders]
+            rows = self.db.query(
+                f"SELECT l.order_id, l.qty, l.status, p.code, p.name FROM repair_order_lines l "
+                f"JOIN products p ON l.product_id = p.id WHERE l.order_id IN ({','.join('?' * len(ids))}) ORDER BY l.id",
+                ids
+            )
+            for r in rows:
+                lines.setdefault(r["order_id"], []).append(r)
+
+        for o in orders:
+            selected = o["id"] == self.selected_order_id
+            frame = ctk.CTkFrame(self.orders_list, fg_color=colors.BOTTON_NAV_ACTIVE_BG if selected else colors.BG_LIGHT)
+            frame.pack(fill="x", padx=6, pady=4)
+            text, bg, fg = ORDER_BADGES[o["status"]]
+            header = f"#{o['id']}  {o['date'][:10]}  Veh: {o['plate'] or '-'}  Tec: {o['tech'] or '-'}  {o['note'] or ''}"
+            ctk.CTkLabel(frame, text=header, text_color=colors.TEXT_PRIMARY, font=("Roboto", 13, "bold")).grid(row=0, column=0, sticky="w", padx=8)
+            ctk.CTkLabel(frame, text=text, fg_color=bg, text_color=fg, corner_radius=8).grid(row=0, column=1, padx=6)
+
+            detail = ", ".join(f"{l['qty']} x {l['code']} ({l['status']})" for l in lines.get(o["id"], [])) or "Sin repuestos"
+            ctk.CTkLabel(frame, text=detail, text_color=colors.TEXT_SECONDARY).grid(row=1, column=0, columnspan=2, sticky="w", padx=8)
+
+            buttons = ctk.CTkFrame(frame, fg_color="transparent")
+            buttons.grid(row=0, column=2, rowspan=2, padx=6, pady=4)
+            ctk.CTkButton(buttons, text="Seleccionar", width=90, command=lambda oid=o["id"]: self.select_order(oid)).pack(side="left", padx=2)
+            if o["status"] == "OPEN":
+                ctk.CTkButton(buttons, text="Asignar", width=80,
+                              command=lambda oid=o["id"]: self.run_order_action(allocate_order, oid, "asignada")).pack(side="left", padx=2)
+                ctk.CTkButton(buttons, text="Cancelar", width=80, fg_color=colors.BADGE_CANCELED_BG,
+                              command=lambda oid=o["id"]: self.run_order_action(cancel_repair_order, oid, "cancelada")).pack(side="left", padx=2)
+            if o["status"] in ("OPEN", "ALLOCATED"):
+                ctk.CTkButton(buttons, text="Finalizar", width=80, fg_color=colors.BADGE_FINISHED_BG,
+                              command=lambda oid=o["id"]: self.run_order_action(finish_repair_order, oid, "finalizada")).pack(side="left", padx=2)
 
     def show_clientes(self):
         self.clear_main()
         ctk.CTkLabel(
             self.main_frame, text="👥 Gestión de Clientes",
             font=("Roboto", 24, "bold"), text_color=colors.TEXT_PRIMARY
-        ).pack(pady=30)
+        ).pack(pady=(30, 10))
+
+        # Alta de cliente y de vehículo para el cliente seleccionado
+        form = ctk.CTkFrame(self.main_frame, fg_color=colors.BG_LIGHT)
+        form.pack(fill="x", padx=20, pady=4)
+        self.c_name = ctk.CTkEntry(form, placeholder_text="Nombre", width=200)
+        self.c_name.grid(row=0, column=0, padx=6, pady=6)
+        self.c_phone = ctk.CTkEntry(form, placeholder_text="Teléfono", width=140)
+        self.c_phone.grid(row=0, column=1, padx=6, pady=6)
+        self.c_email = ctk.CTkEntry(form, placeholder_text="Email", width=200)
+        self.c_email.grid(row=0, column=2, padx=6, pady=6)
+        self.action_button(form, "Nuevo cliente", self.add_customer_ui).grid(row=0, column=3, padx=6, pady=6)
+        self.c_plate = ctk.CTkEntry(form, placeholder_text="Placa", width=200)
+        self.c_plate.grid(row=1, column=0, padx=6, pady=6)
+        self.action_button(form, "Agregar vehículo al cliente", self.add_vehicle_ui).grid(row=1, column=1, columnspan=2, padx=6, pady=6, sticky="w")
+
+        # Búsqueda por prefijo de nombre o placa
+        self.c_search = ctk.CTkEntry(self.main_frame, placeholder_text="Buscar cliente o placa...", width=400)
+        self.c_search.pack(padx=20, pady=6, anchor="w")
+        self.c_search.bind("<KeyRelease>", lambda e: self.schedule_customer_search())
+        self.c_status = ctk.CTkLabel(self.main_frame, text="", text_color=colors.TEXT_SECONDARY)
+        self.c_status.pack(padx=20, anchor="w")
+
+        body = ctk.CTkFrame(self.main_frame, fg_color="transparent")
+        body.pack(fill="both", expand=True, padx=20, pady=(4, 20))
+        self.customers_list = ctk.CTkScrollableFrame(body, fg_color="#FFFFFF", width=360)
+        self.customers_list.pack(side="left", fill="y")
+        history = ctk.CTkFrame(body, fg_color=colors.BG_LIGHT)
+        history.pack(side="left", fill="both", expand=True, padx=(10, 0))
+        self.history_title = ctk.CTkLabel(history, text="Historial de servicio", font=("Roboto", 16, "bold"), text_color=colors.TEXT_PRIMARY)
+        self.history_title.pack(pady=6)
+        self.history_area = ctk.CTkTextbox(history)
+        self.history_area.pack(fill="both", expand=True, padx=8, pady=4)
+        self.history_more = ctk.CTkButton(history, text="Cargar más", command=self.load_history_page, state="disabled")
+        self.history_more.pack(pady=6)
+
+        self.refresh_customer_search()
+
+    def add_customer_ui(self):
+        name = self.c_name.get().strip()
+        if not name:
+            self.c_status.configure(text="El nombre es obligatorio", text_color=colors.BADGE_CANCELED_BG)
+            return
+        self.selected_customer_id = add_customer(self.db, name, self.c_phone.get().strip(), self.c_email.get().strip())
+        for entry in (self.c_name, self.c_phone, self.c_email):
+            entry.delete(0, "end")
+        self.c_status.configure(text=f"Cliente '{name}' registrado", text_color=colors.TEXT_SECONDARY)
+        self.refresh_customer_search()
+
+    def add_vehicle_ui(self):
+        plate = self.c_plate.get().strip()
+        if not plate or self.selected_customer_id is None:
+            self.c_status.configure(text="Selecciona un cliente e ingresa la placa", text_color=colors.BADGE_CANCELED_BG)
+            return
+        try:
+            add_vehicle(self.db, plate, self.selected_customer_id)
+        except Exception as e:
+            self.c_status.configure(text=f"Error: {e}", text_color=colors.BADGE_CANCELED_BG)
+            return
+        self.c_plate.delete(0, "end")
+        self.c_status.configure(text=f"Vehículo {plate.upper()} agregado", text_color=colors.TEXT_SECONDARY)
+        self.refresh_customer_search()
+
+    def select_customer(self, customer_id, name):
+        self.selected_customer_id = customer_id
+        self.c_status.configure(text=f"Cliente seleccionado: {name}", text_color=colors.TEXT_SECONDARY)
+        self.refresh_customer_search()
+
+    def schedule_customer_search(self):
+        # espera a que se deje de teclear antes de consultar y redibujar
+        if self.search_job is not None:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DEBOUNCE_MS, self.refresh_customer_search)
+
+    def refresh_customer_search(self):
+        self.search_job = None
+        for widget in self.customers_list.winfo_children():
+            widget.destroy()
+        prefix = self.c_search.get()
+        customers = search_customers(self.db, prefix)
+        vehicles = customer_vehicles(self.db, [c["id"] for c in customers])
+        for c in customers:
+            selected = c["id"] == self.selected_customer_id
+            frame = ctk.CTkFrame(self.customers_list, fg_color=colors.BOTTON_NAV_ACTIVE_BG if selected else colors.BG_LIGHT)
+            frame.pack(fill="x", padx=4, pady=3)
+            ctk.CTkButton(
+                frame, text=f"{c['name']}  {c['phone'] or ''}", anchor="w", fg_color="transparent",
+                text_color=colors.TEXT_PRIMARY, hover_color=colors.BOTON_NAV_HOVER_BG,
+                command=lambda cid=c["id"], n=c["name"]: self.select_customer(cid, n)
+            ).pack(fill="x")
+            for v in vehicles.get(c["id"], []):
+                self.vehicle_link(frame, v["id"], v["plate"])
+        if prefix.strip():
+            for v in search_vehicles(self.db, prefix):
+                self.vehicle_link(self.customers_list, v["id"], v["plate"], v["customer"] or v["owner"])
+
+    def vehicle_link(self, parent, vehicle_id, plate, owner=None):
+        text = f"🚗 {plate}" + (f" — {owner}" if owner else "")
+        ctk.CTkButton(
+            parent, text=text, anchor="w", fg_color="transparent", text_color=colors.BOTON_NAV_ACTIVE,
+            hover_color=colors.BOTON_NAV_HOVER_BG, height=24,
+            command=lambda: self.show_vehicle_history(vehicle_id, plate)
+        ).pack(fill="x", padx=(16, 0))
+
+    def show_vehicle_history(self, vehicle_id, plate):
+        self.history_vehicle_id = vehicle_id
+        self.history_cursor = None
+        self.history_title.configure(text=f"Historial de servicio — {plate}")
+        self.history_area.delete(1.0, "end")
+        self.load_history_page()
+
+    def load_history_page(self):
+        if self.history_vehicle_id is None:
+            return
+        rows = vehicle_history(self.db, self.history_vehicle_id, self.history_cursor, HISTORY_PAGE)
+        for r in rows:
+            dt = r["date"][:19].replace("T", " ")
+            self.history_area.insert(
+                "end", f"[{dt}] {r['qty']} x {r['code']} - {r['product']} | Tec: {r['tech'] or '-'} | Ref: {r['reference'] or '-'}\n"
+            )
+        if rows:
+            self.history_cursor = (rows[-1]["date"], rows[-1]["id"])
+        self.history_more.configure(state="normal" if len(rows) == HISTORY_PAGE else "disabled")
 
     def show_inventario(self):
         self.clear_main()
@@ -161,5 +442,8 @@ class TallerApp(ctk.CTk):
 
 
 if __name__ == "__main__":
-    app = TallerApp()
+    init_db()
+    db = DB()
+    app = TallerApp(db)
     app.mainloop()
+    db.close()